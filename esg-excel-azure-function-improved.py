@@ -4,28 +4,152 @@
 ```python
 import os
 import logging
+import asyncio
+import email.utils
+import hashlib
+import random
+import numpy as np
+import orjson
+from azure.core import MatchConditions
 from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential
-from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.core.exceptions import (
+    HttpResponseError, ResourceExistsError, ResourceNotFoundError, ServiceRequestError
+)
+from azure.identity.aio import ManagedIdentityCredential
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
+from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+from azure.storage.blob.aio import BlobClient, BlobServiceClient
 from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, ContentFormat
-from typing import Dict, Any, List, Optional
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Callable, ClassVar, Dict, Any, List, Optional
+from urllib.parse import urlparse
 import time
 from functools import wraps
 
-def retry_on_exception(max_retries: int = 3, delay: float = 1.0, backoff: float = 2.0):
-    """Decorator for retrying functions on exception."""
+@dataclass
+class Metrics:
+    """Per-file processing counters, emitted as a single log record."""
+    # Keeps the record within trace size limits when a document has many bad elements
+    MAX_ERRORS: ClassVar[int] = 20
+    
+    correlation_id: str
+    filename: str
+    cache_hit: bool = False
+    pages_ok: int = 0
+    tables_processed: int = 0
+    kvps_kept: int = 0
+    kvps_skipped: int = 0
+    errors: List[str] = field(default_factory=list)
+    errors_dropped: int = 0
+    
+    def record_error(self, message: str) -> None:
+        """Keep the first MAX_ERRORS failure messages for the flushed record; count the rest."""
+        if len(self.errors) < self.MAX_ERRORS:
+            self.errors.append(message)
+        else:
+            self.errors_dropped += 1
+    
+    def flush(self) -> None:
+        """Emit all counters and collected errors as one JSON log record."""
+        level = logging.WARNING if self.errors else logging.INFO
+        # Serialize only when the record will actually be emitted
+        if logging.getLogger().isEnabledFor(level):
+            logging.log(level, "ESG processing metrics: %s", orjson.dumps(asdict(self)).decode("utf-8"))
+
+# Per-attempt wait for an analysis, and the total across retries; the total leaves
+# at least two minutes of the 10 minute function timeout to write the output
+ANALYSIS_TIMEOUT_SECONDS = int(os.environ.get("DI_ANALYSIS_TIMEOUT", "300"))
+ANALYSIS_BUDGET_SECONDS = min(ANALYSIS_TIMEOUT_SECONDS + 120, 480)
+
+def _retry_after_seconds(response: Any, default: float) -> float:
+    """Parse Retry-After as delta-seconds or an HTTP-date, falling back to default."""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return default
+    
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def _is_transient_error(error: Exception) -> bool:
+    """Only timeouts, throttling and server errors are worth re-submitting; other HTTP errors are permanent."""
+    if isinstance(error, HttpResponseError):
+        status = error.status_code
+        return status is not None and (status in (408, 429) or status >= 500)
+    return True
+
+def _next_retry_delay(error: Exception, retry_delay: float, remaining: float) -> float:
+    """Wait before the next attempt: Retry-After when throttled, otherwise full jitter."""
+    if isinstance(error, HttpResponseError) and error.status_code == 429:
+        wait = _retry_after_seconds(error.response, retry_delay)
+    else:
+        # Full jitter keeps throttled workers from retrying in lockstep
+        wait = random.uniform(0, retry_delay)
+    return max(0.0, min(wait, remaining))
+
+def retry_on_exception(max_retries: int = 3, delay: float = 1.0, backoff: float = 2.0,
+                       max_total: float = 30.0, retry_on: tuple = (HttpResponseError,),
+                       retry_if: Optional[Callable[[Exception], bool]] = None):
+    """
+    Decorator for retrying functions on exception within a total time budget.
+    
+    retry_if, when given, re-raises retry_on exceptions it rejects immediately.
+    """
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             retry_delay = delay
+            start = time.monotonic()
             for attempt in range(max_retries):
                 try:
                     return func(*args, **kwargs)
-                except Exception as e:
-                    if attempt == max_retries - 1:
+                except retry_on as e:
+                    remaining = max_total - (time.monotonic() - start)
+                    if attempt == max_retries - 1 or remaining <= 0 or (retry_if and not retry_if(e)):
                         raise
-                    logging.warning(f"Attempt {attempt + 1} failed: {str(e)}. Retrying in {retry_delay}s...")
-                    time.sleep(retry_delay)
+                    wait = _next_retry_delay(e, retry_delay, remaining)
+                    logging.warning(f"Attempt {attempt + 1} failed: {str(e)}. Retrying in {wait:.2f}s...")
+                    time.sleep(wait)
+                    retry_delay *= backoff
+            return None
+        return wrapper
+    return decorator
+
+def async_retry_on_exception(max_retries: int = 3, delay: float = 1.0, backoff: float = 2.0,
+                             max_total: float = 30.0, retry_on: tuple = (HttpResponseError,),
+                             retry_if: Optional[Callable[[Exception], bool]] = None):
+    """
+    Decorator for retrying coroutines on exception without blocking the event loop.
+    
+    max_total bounds the attempts themselves as well as the waits between them;
+    retry_if, when given, re-raises retry_on exceptions it rejects immediately.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            retry_delay = delay
+            start = time.monotonic()
+            for attempt in range(max_retries):
+                try:
+                    remaining = max_total - (time.monotonic() - start)
+                    return await asyncio.wait_for(func(*args, **kwargs), timeout=max(remaining, 0.0))
+                except retry_on as e:
+                    remaining = max_total - (time.monotonic() - start)
+                    if attempt == max_retries - 1 or remaining <= 0 or (retry_if and not retry_if(e)):
+                        raise
+                    wait = _next_retry_delay(e, retry_delay, remaining)
+                    logging.warning(f"Attempt {attempt + 1} failed: {str(e)}. Retrying in {wait:.2f}s...")
+                    await asyncio.sleep(wait)
                     retry_delay *= backoff
             return None
         return wrapper
@@ -36,6 +160,41 @@ class DocumentAnalyzerImproved:
     
     # Maximum file size in MB
     MAX_FILE_SIZE_MB = 50
+    MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
+    
+    # Supported Excel file extensions
+    VALID_EXTENSIONS = frozenset({'.xlsx', '.xls', '.xlsm'})
+    
+    # Leading bytes of each supported format: Office Open XML is a ZIP
+    # archive, legacy .xls is an OLE compound document
+    ZIP_SIGNATURE = b'PK\x03\x04'
+    OLE_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+    FILE_SIGNATURES = {
+        '.xlsx': ZIP_SIGNATURE,
+        '.xlsm': ZIP_SIGNATURE,
+        '.xls': OLE_SIGNATURE,
+    }
+    SIGNATURE_LENGTH = 8
+    
+    # Document Intelligence model and analysis options used for extraction
+    MODEL_ID = "prebuilt-layout"
+    ANALYSIS_FEATURES = ("tables", "keyValuePairs")
+    LOCALE = "en-US"  # Specify locale for better accuracy
+    
+    # Container holding cached extraction results
+    CACHE_CONTAINER = "di-cache"
+    
+    # Lifetime of the read-only SAS URL handed to Document Intelligence
+    SAS_EXPIRY_MINUTES = 15
+    
+    # Lifetime of the user delegation key that signs SAS URLs under managed identity
+    DELEGATION_KEY_HOURS = 1
+    
+    # Minimum confidence for a key-value pair to be kept
+    MIN_KVP_CONFIDENCE = 0.5
+    
+    # Top-level keys every cached extraction result must carry
+    CACHED_RESULT_KEYS = ("filename", "pages", "tables", "key_value_pairs", "metadata")
     
     def __init__(self, use_managed_identity: bool = False):
         """
@@ -51,7 +210,9 @@ class DocumentAnalyzerImproved:
         
         # Use managed identity in production, API key in development
         if use_managed_identity:
-            credential = DefaultAzureCredential()
+            # Target managed identity directly instead of probing the default credential chain;
+            # without AZURE_CLIENT_ID the system-assigned identity is used
+            credential = ManagedIdentityCredential(client_id=os.environ.get("AZURE_CLIENT_ID"))
             logging.info("Using managed identity for authentication")
         else:
             api_key = os.environ.get("DOCUMENTINTELLIGENCE_API_KEY")
@@ -60,152 +221,458 @@ class DocumentAnalyzerImproved:
             credential = AzureKeyCredential(api_key)
             logging.info("Using API key for authentication")
         
+        # The SDK default polls every 30s; the service recommends 5s
+        self.poll_interval = int(os.environ.get("DI_POLL_INTERVAL", "5"))
+        self.analysis_timeout = ANALYSIS_TIMEOUT_SECONDS
+        
+        # Continuation tokens of in-flight operations, keyed by blob identity,
+        # so a retry or re-invocation resumes polling instead of re-submitting
+        self._pending_operations: Dict[str, str] = {}
+        
+        self._min_conf = self.MIN_KVP_CONFIDENCE
+        
+        # Markdown content is large and unused by ESG processing; opt in with KEEP_MARKDOWN=1
+        self.keep_markdown = os.environ.get("KEEP_MARKDOWN", "0") == "1"
+        self.content_format = ContentFormat.MARKDOWN if self.keep_markdown else ContentFormat.TEXT
+        
+        # The content format changes the stored payload, so it is part of the cache key
+        self._cache_options = [*self.ANALYSIS_FEATURES, self.content_format.value]
+        
         self.client = DocumentIntelligenceClient(
             endpoint=endpoint,
-            credential=credential
+            credential=credential,
+            polling_interval=self.poll_interval,
+            logging_enable=False
         )
+        
+        # Shared storage client for input/output blobs and the extraction cache
+        account_url = self._storage_account_url() if use_managed_identity else None
+        if account_url:
+            # Identity-based host storage; read URLs are signed with a user delegation key
+            self.blob_service_client = BlobServiceClient(
+                account_url,
+                credential=credential,
+                logging_enable=False
+            )
+            self._account_key = None
+        else:
+            storage_connection = os.environ.get("AzureWebJobsStorage")
+            if not storage_connection:
+                raise ValueError("AzureWebJobsStorage not configured")
+            self.blob_service_client = BlobServiceClient.from_connection_string(
+                storage_connection,
+                logging_enable=False
+            )
+            
+            # Without managed identity, read URLs can only be signed with the account key
+            self._account_key = getattr(self.blob_service_client.credential, "account_key", None)
+            if self._account_key is None:
+                raise ValueError("AzureWebJobsStorage must be a connection string with an AccountKey, "
+                                 "or set USE_MANAGED_IDENTITY=true with AzureWebJobsStorage__accountName")
+        
+        if urlparse(self.blob_service_client.url).hostname in ("127.0.0.1", "localhost"):
+            logging.warning("AzureWebJobsStorage points at a local storage emulator; Document Intelligence "
+                            "cannot fetch files from it, so analyses will fail")
+        
+        # User delegation key and its expiry, fetched on first use under managed identity
+        self._delegation_key: Any = None
+        self._delegation_key_expiry: Optional[datetime] = None
+        
+        self.cache_enabled = os.environ.get("DI_CACHE_ENABLED", "true").lower() == "true"
+        if not self.cache_enabled:
+            logging.info("Extraction cache disabled")
+        
+        # Set once the cache container is known to exist
+        self._cache_container_ready = False
     
-    def validate_file(self, excel_content: bytes, filename: str) -> None:
+    def validate_file(self, size_bytes: int, filename: str) -> None:
         """
         Validate the input file.
         
         Args:
-            excel_content: File content
+            size_bytes: File size from the blob properties
             filename: File name
             
         Raises:
             ValueError: If file validation fails
         """
         # Check file size
-        file_size_mb = len(excel_content) / (1024 * 1024)
-        if file_size_mb > self.MAX_FILE_SIZE_MB:
-            raise ValueError(f"File size {file_size_mb:.2f}MB exceeds maximum {self.MAX_FILE_SIZE_MB}MB")
+        if size_bytes > self.MAX_FILE_SIZE_BYTES:
+            raise ValueError(f"File size {size_bytes / (1024 * 1024):.2f}MB exceeds maximum {self.MAX_FILE_SIZE_MB}MB")
         
         # Check file extension
-        valid_extensions = ['.xlsx', '.xls', '.xlsm']
         file_ext = os.path.splitext(filename)[1].lower()
-        if file_ext not in valid_extensions:
-            raise ValueError(f"Invalid file extension {file_ext}. Supported: {valid_extensions}")
+        if file_ext not in self.VALID_EXTENSIONS:
+            raise ValueError(f"Invalid file extension {file_ext}. Supported: {sorted(self.VALID_EXTENSIONS)}")
         
-        logging.info(f"File validation passed: {filename} ({file_size_mb:.2f}MB)")
+        logging.info(f"File validation passed: {filename} ({size_bytes} bytes)")
     
-    @retry_on_exception(max_retries=3, delay=2.0)
-    def analyze_excel(self, excel_content: bytes, filename: str) -> Dict[str, Any]:
+    def validate_signature(self, header: bytes, filename: str) -> None:
+        """
+        Check the leading bytes match the file extension, so empty or corrupt
+        files fail without a Document Intelligence call.
+        
+        Args:
+            header: First SIGNATURE_LENGTH bytes of the file
+            filename: File name
+            
+        Raises:
+            ValueError: If the content does not match the extension
+        """
+        file_ext = os.path.splitext(filename)[1].lower()
+        signature = self.FILE_SIGNATURES.get(file_ext)
+        if signature is None:
+            return  # Unsupported extensions are reported by validate_file
+        
+        if not header.startswith(signature):
+            if file_ext == '.xls':
+                raise ValueError("Not a valid Excel 97-2003 (OLE) file")
+            raise ValueError("Not a valid Office Open XML file")
+    
+    # A timed-out analysis is retried so it can resume from its continuation token; each
+    # re-submission is billed, so permanent failures (bad input, auth, failed operations) are not retried
+    @async_retry_on_exception(max_retries=3, delay=2.0, max_total=ANALYSIS_BUDGET_SECONDS,
+                              retry_on=(HttpResponseError, ServiceRequestError, asyncio.TimeoutError),
+                              retry_if=_is_transient_error)
+    async def analyze_excel(self, excel_url: str, filename: str, size_bytes: int,
+                            source_id: str, content_hash: Optional[str],
+                            metrics: Metrics) -> Dict[str, Any]:
         """
         Analyze Excel file using Document Intelligence with retry logic.
         
+        The service fetches the file itself from excel_url, so the workbook is
+        never loaded into worker memory.
+        
         Args:
-            excel_content: Excel file content as bytes
+            excel_url: Read-only SAS URL of the Excel blob
             filename: Name of the Excel file
+            size_bytes: File size from the blob properties
+            source_id: Blob identity from blob_identity(); resumes an in-flight operation
+            content_hash: Digest from content_digest() keying the extraction cache,
+                or None to bypass the cache
+            metrics: Counters for this file; the caller owns and flushes them
             
         Returns:
             Extracted data as dictionary
         """
         # Validate file first
-        self.validate_file(excel_content, filename)
+        self.validate_file(size_bytes, filename)
+        
+        cache_path = self._cache_path(content_hash, self._cache_options) if content_hash else None
+        
+        cached_data = await self._get_cached_result(cache_path) if cache_path else None
+        if cached_data is not None:
+            logging.info(f"Cache hit for {filename}; skipping Document Intelligence analysis")
+            metrics.cache_hit = True
+            cached_data["filename"] = filename
+            return cached_data
         
         logging.info(f"Starting Document Intelligence analysis for {filename}")
         
         try:
-            # Start analysis
-            poller = self.client.begin_analyze_document(
-                model_id="prebuilt-layout",
-                analyze_request=AnalyzeDocumentRequest(
-                    bytes_source=excel_content
-                ),
-                features=["tables", "keyValuePairs"],
-                output_content_format=ContentFormat.MARKDOWN,
-                locale="en-US"  # Specify locale for better accuracy
-            )
+            continuation_token = self._pending_operations.get(source_id)
             
-            # Poll with timeout
-            result = poller.result(timeout=300)  # 5 minute timeout
+            if continuation_token:
+                # Resume the operation submitted by a previous attempt
+                logging.info(f"Resuming Document Intelligence operation for {filename}")
+                poller = await self.client.begin_analyze_document(
+                    model_id=self.MODEL_ID,
+                    continuation_token=continuation_token,
+                    polling_interval=self.poll_interval
+                )
+            else:
+                # Start analysis
+                poller = await self.client.begin_analyze_document(
+                    model_id=self.MODEL_ID,
+                    analyze_request=AnalyzeDocumentRequest(
+                        url_source=excel_url
+                    ),
+                    features=self.ANALYSIS_FEATURES,
+                    output_content_format=self.content_format,
+                    locale=self.LOCALE,
+                    polling_interval=self.poll_interval
+                )
+                self._pending_operations[source_id] = poller.continuation_token()
+            
+            # Poll with timeout; the event loop is free to serve other blobs meanwhile
+            result = await asyncio.wait_for(
+                self._wait_for_result(poller),
+                timeout=self.analysis_timeout
+            )
+            self._pending_operations.pop(source_id, None)
             
             # Extract and structure data
-            extracted_data = self._structure_results(result, filename)
+            extracted_data = self._structure_results(result, filename, metrics)
+            
+            if cache_path:
+                await self._store_cached_result(cache_path, extracted_data, self._cache_options)
             
             logging.info(f"Successfully analyzed {filename}. Found {len(extracted_data.get('tables', []))} tables")
             return extracted_data
             
+        except asyncio.TimeoutError:
+            # Keep the continuation token so the next attempt resumes polling
+            logging.error(f"Document Intelligence analysis timed out after {self.analysis_timeout}s")
+            raise
         except Exception as e:
+            self._pending_operations.pop(source_id, None)
             logging.error(f"Failed to analyze document: {str(e)}")
             raise
     
-    def _structure_results(self, result: Any, filename: str) -> Dict[str, Any]:
-        """Structure the analysis results."""
+    @staticmethod
+    def blob_identity(container: str, blob_name: str, etag: str) -> str:
+        """Identify one version of a blob; a re-upload gets a new ETag and a new identity."""
+        return f"{container}/{blob_name}@{etag}"
+    
+    async def content_digest(self, blob_client: BlobClient, etag: str) -> Optional[str]:
+        """
+        SHA-256 of a blob's content, streamed in chunks so memory stays bounded.
+        
+        Content-MD5 is not used: for block uploads it is whatever the client
+        sent and the service never verifies it. Returns None when the cache is
+        disabled or the blob cannot be read, so the analysis runs uncached.
+        """
+        if not self.cache_enabled:
+            return None
+        
+        digest = hashlib.sha256()
+        try:
+            # Pin the version whose properties were validated
+            downloader = await blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfNotModified)
+            async for chunk in downloader.chunks():
+                digest.update(chunk)
+        except Exception as e:
+            logging.warning(f"Skipping extraction cache for {blob_client.blob_name}: {str(e)}")
+            return None
+        return digest.hexdigest()
+    
+    def discard_pending_operation(self, operation_key: str) -> None:
+        """Forget an operation's continuation token once no more attempts will resume it."""
+        self._pending_operations.pop(operation_key, None)
+    
+    async def _wait_for_result(self, poller: Any) -> Any:
+        """Wait for the poller, honoring Retry-After when polling is throttled."""
+        while True:
+            try:
+                return await poller.result()
+            except HttpResponseError as e:
+                if e.status_code != 429:
+                    raise
+                retry_after = _retry_after_seconds(e.response, float(self.poll_interval))
+                logging.warning(f"Polling throttled (429). Resuming in {retry_after}s...")
+                await asyncio.sleep(retry_after)
+                # Rebuild the poller from its token so the operation ID is not lost
+                poller = await self.client.begin_analyze_document(
+                    model_id=self.MODEL_ID,
+                    continuation_token=poller.continuation_token(),
+                    polling_interval=self.poll_interval
+                )
+    
+    @staticmethod
+    def _hash_parts(*parts: bytes) -> str:
+        """SHA-256 over length-prefixed parts so distinct inputs never concatenate alike."""
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(len(part).to_bytes(8, "big"))
+            digest.update(part)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def _storage_account_url() -> Optional[str]:
+        """Return the blob endpoint of identity-based host storage, if configured."""
+        service_uri = os.environ.get("AzureWebJobsStorage__blobServiceUri")
+        if service_uri:
+            return service_uri
+        account_name = os.environ.get("AzureWebJobsStorage__accountName")
+        if account_name:
+            return f"https://{account_name}.blob.core.windows.net"
+        return None
+    
+    async def generate_read_url(self, blob_client: BlobClient) -> str:
+        """Return a short-lived read-only SAS URL for a blob."""
+        expiry = datetime.now(timezone.utc) + timedelta(minutes=self.SAS_EXPIRY_MINUTES)
+        if self._account_key is not None:
+            signing = {"account_key": self._account_key}
+        else:
+            signing = {"user_delegation_key": await self._get_delegation_key(expiry)}
+        
+        sas_token = generate_blob_sas(
+            account_name=blob_client.account_name,
+            container_name=blob_client.container_name,
+            blob_name=blob_client.blob_name,
+            permission=BlobSasPermissions(read=True),
+            expiry=expiry,
+            **signing
+        )
+        return f"{blob_client.url}?{sas_token}"
+    
+    async def _get_delegation_key(self, valid_until: datetime) -> Any:
+        """Return a cached user delegation key, fetching a new one before it would expire."""
+        if self._delegation_key is None or self._delegation_key_expiry < valid_until:
+            # Concurrent refreshes just fetch equivalent keys; the last one is kept
+            now = datetime.now(timezone.utc)
+            key_expiry = now + timedelta(hours=self.DELEGATION_KEY_HOURS)
+            self._delegation_key = await self.blob_service_client.get_user_delegation_key(
+                key_start_time=now - timedelta(minutes=5),
+                key_expiry_time=key_expiry
+            )
+            self._delegation_key_expiry = key_expiry
+        return self._delegation_key
+    
+    def _cache_path(self, content_hash: str, features: List[str]) -> str:
+        """Build the cache path for file content and a set of analysis options."""
+        encoded_features = [feature.encode("utf-8") for feature in features]
+        features_hash = self._hash_parts(*encoded_features)[:16]
+        source_hash = self._hash_parts(self.MODEL_ID.encode("utf-8"), *encoded_features, content_hash.encode("utf-8"))
+        return f"{self.MODEL_ID}/{features_hash}/{source_hash}.json"
+    
+    async def _get_cached_result(self, cache_path: str) -> Optional[Dict[str, Any]]:
+        """Return a previously stored extraction result, or None on a miss."""
+        if not self.cache_enabled:
+            return None
+        
+        blob_client = self.blob_service_client.get_blob_client(self.CACHE_CONTAINER, cache_path)
+        try:
+            downloader = await blob_client.download_blob()
+            cached_data = orjson.loads(await downloader.readall())
+        except ResourceNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable cache entry {cache_path}: {str(e)}")
+            return None
+        
+        # Revalidate so a truncated or foreign blob never reaches the processor
+        if not isinstance(cached_data, dict) or any(key not in cached_data for key in self.CACHED_RESULT_KEYS):
+            logging.warning(f"Ignoring malformed cache entry {cache_path}")
+            return None
+        
+        return cached_data
+    
+    async def _store_cached_result(self, cache_path: str, extracted_data: Dict[str, Any],
+                                   features: List[str]) -> None:
+        """Store an extraction result; cache failures never fail the analysis."""
+        if not self.cache_enabled:
+            return
+        
+        blob_client = self.blob_service_client.get_blob_client(self.CACHE_CONTAINER, cache_path)
+        try:
+            await self._ensure_cache_container()
+            await blob_client.upload_blob(
+                orjson.dumps(extracted_data, option=orjson.OPT_NON_STR_KEYS),
+                overwrite=True,
+                metadata={
+                    "model": self.MODEL_ID,
+                    "features": ",".join(features),
+                    "ts": str(int(time.time()))
+                }
+            )
+        except Exception as e:
+            logging.warning(f"Failed to write cache entry {cache_path}: {str(e)}")
+    
+    async def _ensure_cache_container(self) -> None:
+        """Create the cache container on first write; lookups before that are plain misses."""
+        if self._cache_container_ready:
+            return
+        
+        try:
+            await self.blob_service_client.create_container(self.CACHE_CONTAINER)
+            logging.info(f"Created cache container {self.CACHE_CONTAINER}")
+        except ResourceExistsError:
+            pass
+        self._cache_container_ready = True
+    
+    def _structure_results(self, result: Any, filename: str, metrics: Metrics) -> Dict[str, Any]:
+        """Structure the analysis results, counting outcomes in metrics."""
+        # AnalyzeResult always defines these attributes; unset ones are None
+        pages = result.pages or ()
+        tables = result.tables or ()
+        kvps = result.key_value_pairs or ()
+        
         extracted_data = {
             "filename": filename,
             "analysis_timestamp": time.time(),
             "pages": [],
             "tables": [],
             "key_value_pairs": [],
-            "content": "",
+            "content": (result.content or "") if self.keep_markdown else "",
             "metadata": {
-                "page_count": len(getattr(result, 'pages', [])),
-                "table_count": len(getattr(result, 'tables', [])),
+                "page_count": len(pages),
+                "table_count": len(tables),
                 "confidence_scores": []
             }
         }
         
-        # Extract content with error handling
-        if hasattr(result, 'content'):
-            extracted_data["content"] = result.content
-        
         # Process pages safely
-        if hasattr(result, 'pages'):
-            for page in result.pages:
-                try:
-                    page_data = self._extract_page_data(page)
-                    extracted_data["pages"].append(page_data)
-                except Exception as e:
-                    logging.warning(f"Error processing page {getattr(page, 'page_number', 'unknown')}: {str(e)}")
+        append_page = extracted_data["pages"].append
+        for page in pages:
+            try:
+                append_page(self._extract_page_data(page))
+                metrics.pages_ok += 1
+            except Exception as e:
+                metrics.record_error(f"page {getattr(page, 'page_number', 'unknown')}: {str(e)}")
         
         # Process tables with validation
-        if hasattr(result, 'tables'):
-            for idx, table in enumerate(result.tables):
-                try:
-                    table_data = self._extract_table_data(table, idx)
-                    if table_data["cells"]:  # Only add non-empty tables
-                        extracted_data["tables"].append(table_data)
-                except Exception as e:
-                    logging.warning(f"Error processing table {idx}: {str(e)}")
+        append_table = extracted_data["tables"].append
+        for idx, table in enumerate(tables):
+            try:
+                table_data = self._extract_table_data(table, idx)
+                if table_data["cells"]:  # Only add non-empty tables
+                    append_table(table_data)
+                    metrics.tables_processed += 1
+            except Exception as e:
+                metrics.record_error(f"table {idx}: {str(e)}")
         
         # Process key-value pairs with confidence filtering
-        if hasattr(result, 'key_value_pairs'):
-            for kvp in result.key_value_pairs:
-                try:
-                    if self._is_valid_kvp(kvp):
-                        kvp_data = {
-                            "key": kvp.key.content if kvp.key else "",
-                            "value": kvp.value.content if kvp.value else "",
-                            "confidence": getattr(kvp, 'confidence', 0.0)
-                        }
-                        extracted_data["key_value_pairs"].append(kvp_data)
-                        extracted_data["metadata"]["confidence_scores"].append(kvp_data["confidence"])
-                except Exception as e:
-                    logging.warning(f"Error processing key-value pair: {str(e)}")
-        
-        # Calculate average confidence
-        if extracted_data["metadata"]["confidence_scores"]:
-            avg_confidence = sum(extracted_data["metadata"]["confidence_scores"]) / len(extracted_data["metadata"]["confidence_scores"])
-            extracted_data["metadata"]["average_confidence"] = avg_confidence
+        confidence_scores = extracted_data["metadata"]["confidence_scores"]
+        confidence_sum = 0.0
+        
+        # Bind hot-loop lookups once
+        is_valid_kvp = self._is_valid_kvp
+        append_kvp = extracted_data["key_value_pairs"].append
+        append_confidence = confidence_scores.append
+        
+        for kvp in kvps:
+            try:
+                if is_valid_kvp(kvp):
+                    confidence = kvp.confidence or 0.0
+                    append_kvp({
+                        "key": kvp.key.content,
+                        "value": kvp.value.content,
+                        "confidence": confidence
+                    })
+                    append_confidence(confidence)
+                    confidence_sum += confidence
+                else:
+                    metrics.kvps_skipped += 1
+            except Exception as e:
+                metrics.kvps_skipped += 1
+                metrics.record_error(f"key-value pair: {str(e)}")
+        
+        metrics.kvps_kept = len(confidence_scores)
+        
+        # Average confidence from the running sum
+        if confidence_scores:
+            extracted_data["metadata"]["average_confidence"] = confidence_sum / len(confidence_scores)
         
         return extracted_data
     
     def _extract_page_data(self, page: Any) -> Dict[str, Any]:
         """Extract data from a page object."""
+        # DocumentPage/DocumentLine define every attribute; unset ones are None.
+        # The empty tuple default is a shared constant, so missing polygons allocate nothing.
+        lines = page.lines or ()
         return {
-            "page_number": getattr(page, 'page_number', 0),
-            "width": getattr(page, 'width', 0),
-            "height": getattr(page, 'height', 0),
-            "unit": getattr(page, 'unit', 'pixel'),
+            "page_number": page.page_number or 0,
+            "width": page.width or 0,
+            "height": page.height or 0,
+            "unit": page.unit or 'pixel',
             "lines": [
                 {
                     "content": line.content,
-                    "polygon": getattr(line, 'polygon', [])
+                    "polygon": line.polygon or ()
                 }
-                for line in getattr(page, 'lines', [])
-                if hasattr(line, 'content')
+                for line in lines
+                if line.content is not None
             ]
         }
     
@@ -213,62 +680,65 @@ class DocumentAnalyzerImproved:
         """Extract and validate table data."""
         table_data = {
             "table_id": table_idx,
-            "row_count": getattr(table, 'row_count', 0),
-            "column_count": getattr(table, 'column_count', 0),
+            "row_count": table.row_count or 0,
+            "column_count": table.column_count or 0,
             "cells": [],
             "headers": []
         }
         
-        if hasattr(table, 'cells'):
-            # Sort cells by position
-            sorted_cells = sorted(
-                table.cells,
-                key=lambda c: (c.row_index, c.column_index)
+        cells = table.cells
+        if cells:
+            append_cell = table_data["cells"].append
+            append_header = table_data["headers"].append
+            
+            # Sort cells by position with a C-level lexsort instead of a Python key function
+            positions = np.fromiter(
+                ((c.row_index, c.column_index) for c in cells),
+                dtype=[("row", "i4"), ("column", "i4")],
+                count=len(cells)
             )
+            order = np.lexsort((positions["column"], positions["row"]))
             
-            for cell in sorted_cells:
+            for idx in order.tolist():
+                cell = cells[idx]
                 cell_data = {
                     "row_index": cell.row_index,
                     "column_index": cell.column_index,
                     "content": cell.content.strip() if cell.content else "",
-                    "row_span": getattr(cell, 'row_span', 1),
-                    "column_span": getattr(cell, 'column_span', 1),
+                    "row_span": cell.row_span or 1,
+                    "column_span": cell.column_span or 1,
                     "is_header": cell.row_index == 0  # Assume first row is header
                 }
                 
-                table_data["cells"].append(cell_data)
+                append_cell(cell_data)
                 
                 # Extract headers
                 if cell_data["is_header"]:
-                    table_data["headers"].append(cell_data["content"])
+                    append_header(cell_data["content"])
         
         return table_data
     
     def _is_valid_kvp(self, kvp: Any) -> bool:
         """Check if a key-value pair is valid."""
-        if not kvp:
-            return False
-        
-        # Must have both key and value
-        if not hasattr(kvp, 'key') or not hasattr(kvp, 'value'):
-            return False
-        
-        # Check confidence threshold
-        confidence = getattr(kvp, 'confidence', 0.0)
-        if confidence < 0.5:  # Minimum confidence threshold
-            return False
-        
-        return True
+        # Must have both key and value and meet the confidence threshold
+        return (
+            kvp is not None
+            and kvp.key is not None
+            and kvp.value is not None
+            and (kvp.confidence or 0.0) >= self._min_conf
+        )
 
 ## File: function_app_improved.py
 ```python
 import azure.functions as func
+import asyncio
 import logging
-import json
+import orjson
 import os
-from utils.document_analyzer_improved import DocumentAnalyzerImproved
+import threading
+from utils.document_analyzer_improved import DocumentAnalyzerImproved, Metrics
 from utils.data_processor import ESGDataProcessor
-from typing import Optional
+from typing import List, Optional
 import traceback
 
 # Configure logging
@@ -277,78 +747,195 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
+# Per-request HTTP logs from the Azure SDK dominate CPU time on small documents
+logging.getLogger("azure.core.pipeline.policies.http_logging_policy").setLevel(logging.WARNING)
+
 # Initialize the function app
 app = func.FunctionApp()
 
+# Blob containers for input workbooks and JSON results
+INPUT_CONTAINER = "input-files"
+OUTPUT_CONTAINER = "output-files"
+
+# Maximum concurrent Document Intelligence analyses per batch
+MAX_CONCURRENT_ANALYSES = int(os.environ.get("DI_MAX_CONCURRENCY", "10"))
+
 # Global initialization for better performance
 doc_analyzer: Optional[DocumentAnalyzerImproved] = None
 data_processor: Optional[ESGDataProcessor] = None
+_analyzers_lock = threading.Lock()
 
 def get_analyzers():
-    """Get or create analyzer instances."""
+    """Get or create analyzer instances.
+
+    The async Document Intelligence client is built once per worker so every
+    invocation shares the same aiohttp transport and connection pool.
+    """
     global doc_analyzer, data_processor
     
-    if doc_analyzer is None:
-        use_managed_identity = os.environ.get("USE_MANAGED_IDENTITY", "false").lower() == "true"
-        doc_analyzer = DocumentAnalyzerImproved(use_managed_identity=use_managed_identity)
+    if doc_analyzer is not None and data_processor is not None:
+        return doc_analyzer, data_processor
     
-    if data_processor is None:
-        data_processor = ESGDataProcessor()
+    # Concurrent first invocations must not each build their own clients
+    with _analyzers_lock:
+        if doc_analyzer is None:
+            use_managed_identity = os.environ.get("USE_MANAGED_IDENTITY", "false").lower() == "true"
+            doc_analyzer = DocumentAnalyzerImproved(use_managed_identity=use_managed_identity)
+        
+        if data_processor is None:
+            data_processor = ESGDataProcessor()
     
     return doc_analyzer, data_processor
 
-@app.blob_trigger(
-    arg_name="inputblob",
-    path="input-files/{name}",
-    connection="AzureWebJobsStorage"
-)
-@app.blob_output(
-    arg_name="outputblob",
-    path="output-files/{name}.json",
-    connection="AzureWebJobsStorage"
+# Build the clients while the host initializes the worker instead of on the first event
+try:
+    get_analyzers()
+except Exception as e:
+    logging.warning(f"Analyzer warmup failed, retrying on first invocation: {str(e)}")
+
+def get_blob_names(events: List[func.EventHubEvent]) -> List[str]:
+    """Extract unique input blob names from Event Grid BlobCreated events."""
+    subject_prefix = f"/blobServices/default/containers/{INPUT_CONTAINER}/blobs/"
+    blob_names = []
+    
+    for event in events:
+        # A malformed message is skipped so it cannot take the rest of the batch down with it
+        try:
+            payload = orjson.loads(event.get_body())
+        except orjson.JSONDecodeError as e:
+            logging.error(f"Skipping malformed event (sequence number {event.sequence_number}): {str(e)}")
+            continue
+        grid_events = payload if isinstance(payload, list) else [payload]
+        
+        for grid_event in grid_events:
+            if not isinstance(grid_event, dict):
+                logging.error(f"Skipping non-object Event Grid event (sequence number {event.sequence_number})")
+                continue
+            if grid_event.get("eventType") != "Microsoft.Storage.BlobCreated":
+                continue
+            subject = grid_event.get("subject")
+            if isinstance(subject, str) and subject.startswith(subject_prefix):
+                blob_names.append(subject[len(subject_prefix):])
+    
+    # Event Grid delivers at least once; a duplicate must not analyze and write the same blob twice
+    return list(dict.fromkeys(blob_names))
+
+@app.event_hub_message_trigger(
+    arg_name="events",
+    event_hub_name="esg-blob-events",
+    connection="EventHubConnection",
+    cardinality=func.Cardinality.MANY
 )
-def process_esg_excel(inputblob: func.InputStream, outputblob: func.Out[str]) -> None:
+async def process_esg_excel_batch(events: List[func.EventHubEvent]) -> None:
     """
-    Azure Function triggered by blob upload to process ESG Excel files.
+    Azure Function triggered by a batch of blob upload events to process ESG Excel files.
+    
+    Event Grid forwards BlobCreated events for the input container to Event Hubs,
+    so a single invocation receives many uploads and analyzes them concurrently.
     
     Args:
-        inputblob: Input Excel file from blob storage
-        outputblob: Output JSON file to blob storage
+        events: Batch of Event Hubs messages carrying Event Grid events
+    """
+    blob_names = get_blob_names(events)
+    logging.info(f"Processing batch of {len(blob_names)} ESG Excel files")
+    if len(blob_names) > MAX_CONCURRENT_ANALYSES:
+        # Files beyond the concurrency limit queue behind the first wave and may hit the function timeout
+        logging.warning(
+            f"Batch of {len(blob_names)} files exceeds DI_MAX_CONCURRENCY={MAX_CONCURRENT_ANALYSES}; "
+            f"keep maxEventBatchSize in host.json at or below it"
+        )
+    
+    # One set of clients is shared by every file in the batch
+    doc_analyzer, data_processor = get_analyzers()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_ANALYSES)
+    
+    async def analyze_one(blob_name: str) -> None:
+        async with semaphore:
+            await process_esg_excel(blob_name, doc_analyzer, data_processor)
+    
+    results = await asyncio.gather(
+        *[analyze_one(name) for name in blob_names],
+        return_exceptions=True
+    )
+    
+    failed = [name for name, result in zip(blob_names, results) if isinstance(result, Exception)]
+    if failed:
+        # Event Hubs does not redeliver the batch, so this only surfaces the failure in monitoring;
+        # every failed file already has an error document in the output container
+        raise RuntimeError(f"Failed to process {len(failed)} of {len(blob_names)} files: {', '.join(failed)}")
+
+def to_json(data: dict) -> bytes:
+    """Serialize a result document as indented UTF-8 JSON."""
+    return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
+async def write_output(doc_analyzer: DocumentAnalyzerImproved, blob_name: str, output_json: bytes) -> None:
+    """Write a JSON result next to the input file name in the output container."""
+    blob_client = doc_analyzer.blob_service_client.get_blob_client(OUTPUT_CONTAINER, f"{blob_name}.json")
+    await blob_client.upload_blob(output_json, overwrite=True)
+
+async def process_esg_excel(blob_name: str, doc_analyzer: DocumentAnalyzerImproved,
+                            data_processor: ESGDataProcessor) -> None:
+    """
+    Process a single ESG Excel file from the input container.
+    
+    Args:
+        blob_name: Name of the Excel file in the input container
+        doc_analyzer: Shared Document Intelligence analyzer
+        data_processor: Shared ESG data processor
     """
     # Create correlation ID for tracking
     import uuid
     correlation_id = str(uuid.uuid4())
     
-    logging.info(f"[{correlation_id}] Processing ESG Excel file: {inputblob.name}")
-    logging.info(f"[{correlation_id}] File size: {inputblob.length} bytes")
+    logging.info(f"[{correlation_id}] Processing ESG Excel file: {blob_name}")
+    
+    # Counters are collected per file and logged once when processing ends
+    metrics = Metrics(correlation_id, blob_name)
+    
+    # Set once the blob version is known
+    operation_key: Optional[str] = None
     
     # Initialize error output
     error_output = {
         "status": "error",
-        "filename": inputblob.name,
+        "filename": blob_name,
         "correlation_id": correlation_id,
         "error": None,
         "details": None
     }
     
     try:
-        # Get analyzer instances
-        doc_analyzer, data_processor = get_analyzers()
+        # Only the blob properties are read; Document Intelligence fetches the content
+        blob_client = doc_analyzer.blob_service_client.get_blob_client(INPUT_CONTAINER, blob_name)
+        properties = await blob_client.get_blob_properties()
+        file_size = properties.size
+        
+        logging.info(f"[{correlation_id}] File size: {file_size} bytes")
+        
+        # Reject oversized, empty or corrupt workbooks before downloading or paying for an analysis
+        doc_analyzer.validate_file(file_size, blob_name)
+        header = b""
+        if file_size:
+            downloader = await blob_client.download_blob(offset=0, length=doc_analyzer.SIGNATURE_LENGTH)
+            header = await downloader.readall()
+        doc_analyzer.validate_signature(header, blob_name)
         
-        # Read the Excel file content
-        excel_content = inputblob.read()
+        # Keys any in-flight operation for this blob version
+        operation_key = doc_analyzer.blob_identity(INPUT_CONTAINER, blob_name, properties.etag)
+        
+        # Identical content hits the cache whatever the blob name or upload
+        content_hash = await doc_analyzer.content_digest(blob_client, properties.etag)
         
         # Analyze document with Azure AI Document Intelligence
-        extracted_data = doc_analyzer.analyze_excel(
-            excel_content, 
-            inputblob.name
+        extracted_data = await doc_analyzer.analyze_excel(
+            await doc_analyzer.generate_read_url(blob_client),
+            blob_name,
+            file_size,
+            operation_key,
+            content_hash,
+            metrics=metrics
         )
         
-        # Log extraction metrics
-        logging.info(f"[{correlation_id}] Extraction complete. "
-                    f"Tables: {len(extracted_data.get('tables', []))}, "
-                    f"KV Pairs: {len(extracted_data.get('key_value_pairs', []))}")
-        
         # Process and structure ESG data
         esg_data = data_processor.process_esg_data(extracted_data)
         
@@ -356,16 +943,16 @@ def process_esg_excel(inputblob: func.InputStream, outputblob: func.Out[str]) ->
         esg_data["processing_metadata"] = {
             "correlation_id": correlation_id,
             "status": "success",
-            "file_size_bytes": inputblob.length,
+            "file_size_bytes": file_size,
             "processing_timestamp": extracted_data.get("analysis_timestamp"),
             "document_intelligence_metadata": extracted_data.get("metadata", {})
         }
         
         # Convert to JSON and save
-        output_json = json.dumps(esg_data, indent=2, ensure_ascii=False)
-        outputblob.set(output_json)
+        output_json = to_json(esg_data)
+        await write_output(doc_analyzer, blob_name, output_json)
         
-        logging.info(f"[{correlation_id}] Successfully processed {inputblob.name}. "
+        logging.info(f"[{correlation_id}] Successfully processed {blob_name}. "
                     f"Found {len(esg_data.get('metrics', []))} ESG metrics")
         
     except ValueError as ve:
@@ -373,7 +960,7 @@ def process_esg_excel(inputblob: func.InputStream, outputblob: func.Out[str]) ->
         error_output["error"] = "Validation Error"
         error_output["details"] = str(ve)
         logging.error(f"[{correlation_id}] Validation error: {str(ve)}")
-        outputblob.set(json.dumps(error_output, indent=2))
+        await write_output(doc_analyzer, blob_name, to_json(error_output))
         
     except Exception as e:
         # Unexpected errors
@@ -381,23 +968,41 @@ def process_esg_excel(inputblob: func.InputStream, outputblob: func.Out[str]) ->
         error_output["details"] = str(e)
         error_output["traceback"] = traceback.format_exc()
         
-        logging.error(f"[{correlation_id}] Error processing file {inputblob.name}: {str(e)}")
+        logging.error(f"[{correlation_id}] Error processing file {blob_name}: {str(e)}")
         logging.error(f"[{correlation_id}] Traceback: {traceback.format_exc()}")
         
         # Save error output
-        outputblob.set(json.dumps(error_output, indent=2))
+        await write_output(doc_analyzer, blob_name, to_json(error_output))
         
-        # Re-raise to mark function execution as failed
+        # Re-raise so the batch reports this file as failed
         raise
+    
+    finally:
+        # Retries are exhausted or done; a kept token would only leak
+        if operation_key:
+            doc_analyzer.discard_pending_operation(operation_key)
+        metrics.flush()
 
 ## File: test_esg_processor.py
 ```python
+import os
 import unittest
-from unittest.mock import Mock, patch, MagicMock
+from unittest.mock import AsyncMock, Mock, patch, MagicMock
+from types import SimpleNamespace
 import json
 from utils.data_processor import ESGDataProcessor
 from models.esg_models import ESGMetric
 
+# Analyzer settings for tests; the storage account is never contacted
+TEST_ENV = {
+    "DOCUMENTINTELLIGENCE_ENDPOINT": "https://test.cognitiveservices.azure.com/",
+    "DOCUMENTINTELLIGENCE_API_KEY": "test-key",
+    "AzureWebJobsStorage": (
+        "DefaultEndpointsProtocol=https;AccountName=testaccount;"
+        "AccountKey=dGVzdC1rZXk=;EndpointSuffix=core.windows.net"
+    )
+}
+
 class TestESGDataProcessor(unittest.TestCase):
     """Unit tests for ESG data processor."""
     
@@ -466,10 +1071,7 @@ class TestESGDataProcessor(unittest.TestCase):
 class TestDocumentAnalyzer(unittest.TestCase):
     """Unit tests for document analyzer."""
     
-    @patch.dict(os.environ, {
-        "DOCUMENTINTELLIGENCE_ENDPOINT": "https://test.cognitiveservices.azure.com/",
-        "DOCUMENTINTELLIGENCE_API_KEY": "test-key"
-    })
+    @patch.dict(os.environ, TEST_ENV)
     def test_validate_file(self):
         """Test file validation."""
         from utils.document_analyzer_improved import DocumentAnalyzerImproved
@@ -477,17 +1079,516 @@ class TestDocumentAnalyzer(unittest.TestCase):
         analyzer = DocumentAnalyzerImproved(use_managed_identity=False)
         
         # Test valid file
-        valid_content = b"x" * (1024 * 1024)  # 1MB
-        analyzer.validate_file(valid_content, "test.xlsx")
+        valid_size = 1024 * 1024  # 1MB
+        analyzer.validate_file(valid_size, "test.xlsx")
         
         # Test invalid size
-        invalid_content = b"x" * (51 * 1024 * 1024)  # 51MB
+        invalid_size = 51 * 1024 * 1024  # 51MB
         with self.assertRaises(ValueError):
-            analyzer.validate_file(invalid_content, "test.xlsx")
+            analyzer.validate_file(invalid_size, "test.xlsx")
+        
+        # Test size limit is inclusive and extension check is case-insensitive
+        analyzer.validate_file(50 * 1024 * 1024, "TEST.XLSM")
         
         # Test invalid extension
         with self.assertRaises(ValueError):
-            analyzer.validate_file(valid_content, "test.pdf")
+            analyzer.validate_file(valid_size, "test.pdf")
+    
+    @patch.dict(os.environ, TEST_ENV)
+    def test_validate_signature(self):
+        """Test file signature validation."""
+        from utils.document_analyzer_improved import DocumentAnalyzerImproved
+        
+        analyzer = DocumentAnalyzerImproved(use_managed_identity=False)
+        
+        # Test valid headers
+        analyzer.validate_signature(b"PK\x03\x04\x14\x00\x06\x00", "test.xlsx")
+        analyzer.validate_signature(b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "test.xls")
+        
+        # Test empty and mismatched content
+        with self.assertRaises(ValueError):
+            analyzer.validate_signature(b"", "test.xlsx")
+        with self.assertRaises(ValueError):
+            analyzer.validate_signature(b"PK\x03\x04\x14\x00\x06\x00", "test.xls")
+    
+    def test_storage_credential_validation(self):
+        """Test storage settings that cannot sign read URLs are rejected."""
+        from utils.document_analyzer_improved import DocumentAnalyzerImproved
+        
+        # SAS connection strings carry no account key to sign read URLs
+        sas_connection = "BlobEndpoint=https://testaccount.blob.core.windows.net/;SharedAccessSignature=sv=2022-11-02&sig=abc"
+        with patch.dict(os.environ, {**TEST_ENV, "AzureWebJobsStorage": sas_connection}):
+            with self.assertRaises(ValueError):
+                DocumentAnalyzerImproved(use_managed_identity=False)
+        
+        # The emulator is allowed for local development
+        with patch.dict(os.environ, {**TEST_ENV, "AzureWebJobsStorage": "UseDevelopmentStorage=true"}):
+            DocumentAnalyzerImproved(use_managed_identity=False)
+    
+    @patch.dict(os.environ, {**TEST_ENV, "AzureWebJobsStorage__accountName": "identityaccount"})
+    def test_managed_identity_storage(self):
+        """Test identity-based storage signs read URLs with a cached user delegation key."""
+        import asyncio
+        from utils.document_analyzer_improved import DocumentAnalyzerImproved
+        
+        analyzer = DocumentAnalyzerImproved(use_managed_identity=True)
+        self.assertEqual(analyzer.blob_service_client.account_name, "identityaccount")
+        
+        blob_client = analyzer.blob_service_client.get_blob_client("input-files", "a.xlsx")
+        delegation_key = Mock()
+        
+        with patch.object(analyzer.blob_service_client, "get_user_delegation_key",
+                          new_callable=AsyncMock, return_value=delegation_key) as mock_get_key, \
+                patch("utils.document_analyzer_improved.generate_blob_sas", return_value="sig=abc") as mock_sas:
+            url = asyncio.run(analyzer.generate_read_url(blob_client))
+            asyncio.run(analyzer.generate_read_url(blob_client))
+        
+        self.assertEqual(url, f"{blob_client.url}?sig=abc")
+        mock_get_key.assert_awaited_once()
+        self.assertIs(mock_sas.call_args.kwargs["user_delegation_key"], delegation_key)
+        self.assertNotIn("account_key", mock_sas.call_args.kwargs)
+    
+    def test_retry_on_exception(self):
+        """Test retries are limited to the configured exception types."""
+        from utils.document_analyzer_improved import retry_on_exception
+        
+        calls = []
+        
+        @retry_on_exception(max_retries=3, delay=0.0, retry_on=(ConnectionError,))
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ConnectionError("transient")
+            return "ok"
+        
+        self.assertEqual(flaky(), "ok")
+        self.assertEqual(len(calls), 3)
+        
+        @retry_on_exception(max_retries=3, delay=0.0, retry_on=(ConnectionError,))
+        def invalid():
+            calls.append(1)
+            raise ValueError("not retryable")
+        
+        calls.clear()
+        with self.assertRaises(ValueError):
+            invalid()
+        self.assertEqual(len(calls), 1)
+    
+    @patch("utils.document_analyzer_improved.time.sleep")
+    def test_retry_transient_only(self, mock_sleep):
+        """Test permanent HTTP errors are raised at once and transient ones are retried."""
+        from azure.core.exceptions import HttpResponseError
+        from utils.document_analyzer_improved import _is_transient_error, retry_on_exception
+        
+        def http_error(status_code):
+            error = HttpResponseError(message=f"HTTP {status_code}")
+            error.status_code = status_code
+            error.response = Mock(headers={})
+            return error
+        
+        for status_code, expected_calls in [(400, 1), (401, 1), (403, 1), (None, 1),
+                                             (408, 3), (429, 3), (500, 3), (503, 3)]:
+            calls = []
+            
+            @retry_on_exception(max_retries=3, delay=0.0, retry_if=_is_transient_error)
+            def submit():
+                calls.append(1)
+                raise http_error(status_code)
+            
+            with self.assertRaises(HttpResponseError):
+                submit()
+            self.assertEqual(len(calls), expected_calls, msg=status_code)
+    
+    @patch("utils.document_analyzer_improved.time.sleep")
+    def test_retry_jitter_bound(self, mock_sleep):
+        """Test jittered waits never exceed the exponential backoff delay."""
+        from utils.document_analyzer_improved import retry_on_exception
+        
+        @retry_on_exception(max_retries=4, delay=1.0, backoff=2.0, max_total=60.0, retry_on=(ConnectionError,))
+        def always_fails():
+            raise ConnectionError("transient")
+        
+        with self.assertRaises(ConnectionError):
+            always_fails()
+        
+        waits = [c.args[0] for c in mock_sleep.call_args_list]
+        self.assertEqual(len(waits), 3)
+        for attempt, wait in enumerate(waits):
+            self.assertGreaterEqual(wait, 0.0)
+            self.assertLessEqual(wait, 2.0 ** attempt)
+    
+    @patch("utils.document_analyzer_improved.time.sleep")
+    def test_retry_after(self, mock_sleep):
+        """Test throttled retries honour Retry-After in both RFC 9110 forms."""
+        import email.utils
+        import time
+        from azure.core.exceptions import HttpResponseError
+        from utils.document_analyzer_improved import retry_on_exception
+        
+        def throttled(retry_after):
+            error = HttpResponseError(message="throttled")
+            error.status_code = 429
+            error.response = Mock(headers={"Retry-After": retry_after})
+            return error
+        
+        def first_wait(retry_after):
+            calls = []
+            
+            @retry_on_exception(max_retries=2, delay=1.0, max_total=60.0)
+            def call():
+                calls.append(1)
+                if len(calls) == 1:
+                    raise throttled(retry_after)
+                return "ok"
+            
+            mock_sleep.reset_mock()
+            self.assertEqual(call(), "ok")
+            return mock_sleep.call_args.args[0]
+        
+        self.assertEqual(first_wait("7"), 7.0)
+        
+        http_date = email.utils.formatdate(time.time() + 30, usegmt=True)
+        self.assertTrue(25.0 <= first_wait(http_date) <= 30.0)
+        
+        # Unparseable values fall back to the backoff delay instead of raising
+        self.assertEqual(first_wait("soon"), 1.0)
+        
+        # Waits never run past the remaining budget
+        self.assertLessEqual(first_wait("3600"), 60.0)
+    
+    def test_retry_max_total(self):
+        """Test no retry starts once the total time budget is spent."""
+        from utils.document_analyzer_improved import retry_on_exception
+        
+        calls = []
+        
+        @retry_on_exception(max_retries=5, delay=1.0, max_total=30.0, retry_on=(ConnectionError,))
+        def slow_failure():
+            calls.append(1)
+            raise ConnectionError("transient")
+        
+        with patch("utils.document_analyzer_improved.time.monotonic", side_effect=[0.0, 31.0]), \
+                patch("utils.document_analyzer_improved.time.sleep") as mock_sleep:
+            with self.assertRaises(ConnectionError):
+                slow_failure()
+        
+        self.assertEqual(len(calls), 1)
+        mock_sleep.assert_not_called()
+    
+    def test_async_retry_on_exception(self):
+        """Test the async decorator retries, honours Retry-After and bounds each attempt."""
+        import asyncio
+        from azure.core.exceptions import HttpResponseError
+        from utils.document_analyzer_improved import async_retry_on_exception
+        
+        calls = []
+        error = HttpResponseError(message="throttled")
+        error.status_code = 429
+        error.response = Mock(headers={"Retry-After": "5"})
+        
+        @async_retry_on_exception(max_retries=3, delay=1.0, max_total=60.0)
+        async def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise error
+            return "ok"
+        
+        with patch("utils.document_analyzer_improved.asyncio.sleep", new_callable=AsyncMock) as mock_sleep:
+            self.assertEqual(asyncio.run(flaky()), "ok")
+        self.assertEqual(len(calls), 3)
+        self.assertEqual([c.args[0] for c in mock_sleep.await_args_list], [5.0, 5.0])
+        
+        # An attempt that outlives the budget is cancelled rather than left running
+        @async_retry_on_exception(max_retries=3, delay=0.0, max_total=0.05,
+                                  retry_on=(asyncio.TimeoutError,))
+        async def hangs():
+            await asyncio.sleep(10)
+        
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(hangs())
+    
+    def stub_result(self, **overrides):
+        """Build an AnalyzeResult stand-in with one page, one table and one kept key-value pair."""
+        fields = {
+            "content": "# Sustainability Report",
+            "pages": [SimpleNamespace(page_number=1, width=8.5, height=11.0, unit="inch",
+                                      lines=[SimpleNamespace(content="Scope 1", polygon=[0, 0, 1, 0, 1, 1, 0, 1])])],
+            "tables": [SimpleNamespace(row_count=1, column_count=1, cells=[
+                SimpleNamespace(row_index=0, column_index=0, content=" Metric ", row_span=1, column_span=1)
+            ])],
+            "key_value_pairs": [SimpleNamespace(key=SimpleNamespace(content="Scope 1"),
+                                                value=SimpleNamespace(content="1,234 tCO2e"), confidence=0.9)],
+        }
+        fields.update(overrides)
+        return SimpleNamespace(**fields)
+    
+    def kvp(self, key, value, confidence):
+        """Build a key-value pair stand-in; value None leaves the pair without a value."""
+        return SimpleNamespace(key=SimpleNamespace(content=key),
+                               value=None if value is None else SimpleNamespace(content=value),
+                               confidence=confidence)
+    
+    @patch.dict(os.environ, TEST_ENV)
+    def test_structure_results_metrics(self):
+        """Test page, table and key-value pair outcomes are counted in metrics."""
+        from utils.document_analyzer_improved import DocumentAnalyzerImproved, Metrics
+        
+        analyzer = DocumentAnalyzerImproved(use_managed_identity=False)
+        metrics = Metrics("id", "a.xlsx")
+        result = self.stub_result(
+            # The second page has no lines attribute and fails extraction
+            pages=[*self.stub_result().pages, SimpleNamespace(page_number=2)],
+            # Empty tables are dropped without counting as errors
+            tables=[*self.stub_result().tables, SimpleNamespace(row_count=0, column_count=0, cells=[])],
+            key_value_pairs=[self.kvp("Scope 1", "1,234", 0.9), self.kvp("Scope 2", "567", 0.2),
+                             self.kvp("Scope 3", None, 0.9)]
+        )
+        
+        analyzer._structure_results(result, "a.xlsx", metrics)
+        
+        self.assertFalse(metrics.cache_hit)
+        self.assertEqual(metrics.pages_ok, 1)
+        self.assertEqual(metrics.tables_processed, 1)
+        self.assertEqual(metrics.kvps_kept, 1)
+        self.assertEqual(metrics.kvps_skipped, 2)
+        self.assertEqual(len(metrics.errors), 1)
+        self.assertTrue(metrics.errors[0].startswith("page 2:"))
+    
+    def test_metrics_error_cap(self):
+        """Test only the first MAX_ERRORS messages are kept and the rest are counted."""
+        import logging
+        from utils.document_analyzer_improved import Metrics
+        
+        metrics = Metrics("id", "a.xlsx")
+        for idx in range(Metrics.MAX_ERRORS + 5):
+            metrics.record_error(f"key-value pair {idx}")
+        
+        self.assertEqual(len(metrics.errors), Metrics.MAX_ERRORS)
+        self.assertEqual(metrics.errors[0], "key-value pair 0")
+        self.assertEqual(metrics.errors_dropped, 5)
+        
+        with patch("utils.document_analyzer_improved.logging.log") as mock_log:
+            metrics.flush()
+        level, _, payload = mock_log.call_args.args
+        self.assertEqual(level, logging.WARNING)
+        self.assertEqual(json.loads(payload)["errors_dropped"], 5)
+    
+    @patch.dict(os.environ, TEST_ENV)
+    def test_structure_results(self):
+        """Test missing collections and attributes, key-value filtering and the average confidence."""
+        import orjson
+        from utils.document_analyzer_improved import DocumentAnalyzerImproved, Metrics
+        
+        analyzer = DocumentAnalyzerImproved(use_managed_identity=False)
+        
+        # The service leaves absent collections as None
+        empty = analyzer._structure_results(
+            self.stub_result(pages=None, tables=None, key_value_pairs=None), "a.xlsx", Metrics("id", "a.xlsx"))
+        self.assertEqual((empty["pages"], empty["tables"], empty["key_value_pairs"]), ([], [], []))
+        self.assertEqual(empty["metadata"]["page_count"], 0)
+        self.assertEqual(empty["metadata"]["table_count"], 0)
+        self.assertNotIn("average_confidence", empty["metadata"])
+        
+        result = self.stub_result(key_value_pairs=[
+            self.kvp("Scope 1", "1,234", 0.9),
+            self.kvp("Scope 2", "567", 0.7),
+            self.kvp("Scope 3", "89", 0.2),     # Below the confidence threshold
+            self.kvp("Water", None, 0.95),      # Pairs without a value are dropped, not kept as ""
+        ])
+        data = analyzer._structure_results(result, "a.xlsx", Metrics("id", "a.xlsx"))
+        
+        self.assertEqual(data["key_value_pairs"], [
+            {"key": "Scope 1", "value": "1,234", "confidence": 0.9},
+            {"key": "Scope 2", "value": "567", "confidence": 0.7},
+        ])
+        self.assertEqual(data["metadata"]["confidence_scores"], [0.9, 0.7])
+        self.assertAlmostEqual(data["metadata"]["average_confidence"], 0.8)
+        
+        # Unset spans default to 1 and unset polygons serialize as empty lists
+        result = self.stub_result(
+            pages=[SimpleNamespace(page_number=1, width=None, height=None, unit=None, lines=[
+                SimpleNamespace(content="Scope 1", polygon=None),
+                SimpleNamespace(content=None, polygon=[0, 0]),
+            ])],
+            tables=[SimpleNamespace(row_count=1, column_count=1, cells=[
+                SimpleNamespace(row_index=0, column_index=0, content=None, row_span=None, column_span=None)
+            ])]
+        )
+        data = analyzer._structure_results(result, "a.xlsx", Metrics("id", "a.xlsx"))
+        
+        page = data["pages"][0]
+        self.assertEqual((page["width"], page["height"], page["unit"]), (0, 0, "pixel"))
+        self.assertEqual(page["lines"], [{"content": "Scope 1", "polygon": ()}])
+        self.assertEqual(json.loads(orjson.dumps(page))["lines"][0]["polygon"], [])
+        
+        cell = data["tables"][0]["cells"][0]
+        self.assertEqual((cell["row_span"], cell["column_span"], cell["content"]), (1, 1, ""))
+    
+    @patch.dict(os.environ, TEST_ENV)
+    def test_keep_markdown(self):
+        """Test KEEP_MARKDOWN switches the content format, the cache key and the output content."""
+        import hashlib
+        from azure.ai.documentintelligence.models import ContentFormat
+        from utils.document_analyzer_improved import DocumentAnalyzerImproved, Metrics
+        
+        content_hash = hashlib.sha256(b"workbook").hexdigest()
+        result = self.stub_result()
+        
+        os.environ.pop("KEEP_MARKDOWN", None)
+        text_analyzer = DocumentAnalyzerImproved(use_managed_identity=False)
+        os.environ["KEEP_MARKDOWN"] = "1"
+        markdown_analyzer = DocumentAnalyzerImproved(use_managed_identity=False)
+        
+        self.assertEqual(text_analyzer.content_format, ContentFormat.TEXT)
+        self.assertEqual(markdown_analyzer.content_format, ContentFormat.MARKDOWN)
+        
+        self.assertNotEqual(
+            text_analyzer._cache_path(content_hash, text_analyzer._cache_options),
+            markdown_analyzer._cache_path(content_hash, markdown_analyzer._cache_options)
+        )
+        
+        text_data = text_analyzer._structure_results(result, "a.xlsx", Metrics("id", "a.xlsx"))
+        markdown_data = markdown_analyzer._structure_results(result, "a.xlsx", Metrics("id", "a.xlsx"))
+        self.assertEqual(text_data["content"], "")
+        self.assertEqual(markdown_data["content"], "# Sustainability Report")
+    
+    @patch.dict(os.environ, TEST_ENV)
+    def test_extract_table_data_order(self):
+        """Test cells are ordered like a stable sort on (row_index, column_index)."""
+        from utils.document_analyzer_improved import DocumentAnalyzerImproved
+        
+        analyzer = DocumentAnalyzerImproved(use_managed_identity=False)
+        positions = [(1, 1, "b2"), (0, 1, "Value"), (1, 0, "b1"), (0, 0, "Metric"),
+                     (0, 1, "Value (dup)"), (2, 0, "c1"), (1, 0, "b1 (dup)")]
+        cells = [SimpleNamespace(row_index=row, column_index=column, content=content,
+                                 row_span=1, column_span=1)
+                 for row, column, content in positions]
+        table = SimpleNamespace(row_count=3, column_count=2, cells=cells)
+        
+        table_data = analyzer._extract_table_data(table, 0)
+        
+        expected = sorted(cells, key=lambda c: (c.row_index, c.column_index))
+        self.assertEqual([c["content"] for c in table_data["cells"]], [c.content for c in expected])
+        self.assertEqual(table_data["headers"], ["Metric", "Value", "Value (dup)"])
+    
+    @patch.dict(os.environ, TEST_ENV)
+    def test_cache_path(self):
+        """Test cache keys depend on file content and requested features."""
+        import hashlib
+        from utils.document_analyzer_improved import DocumentAnalyzerImproved
+        
+        analyzer = DocumentAnalyzerImproved(use_managed_identity=False)
+        features = ["tables", "keyValuePairs"]
+        content_hash = hashlib.sha256(b"workbook").hexdigest()
+        
+        path = analyzer._cache_path(content_hash, features)
+        self.assertTrue(path.startswith("prebuilt-layout/"))
+        self.assertEqual(path, analyzer._cache_path(content_hash, features))
+        self.assertNotEqual(path, analyzer._cache_path(hashlib.sha256(b"other").hexdigest(), features))
+        
+        # Length prefixing keeps shifted feature boundaries distinct
+        self.assertNotEqual(
+            analyzer._cache_path(content_hash, ["ab", "c"]),
+            analyzer._cache_path(content_hash, ["a", "bc"])
+        )
+    
+    @patch.dict(os.environ, TEST_ENV)
+    def test_content_digest(self):
+        """Test the content hash is streamed and identical for re-uploads under any name."""
+        import asyncio
+        import hashlib
+        from utils.document_analyzer_improved import DocumentAnalyzerImproved
+        
+        analyzer = DocumentAnalyzerImproved(use_managed_identity=False)
+        
+        def blob_client(name, chunks):
+            async def iterate():
+                for chunk in chunks:
+                    yield chunk
+            downloader = Mock()
+            downloader.chunks = iterate
+            client = Mock(blob_name=name)
+            client.download_blob = AsyncMock(return_value=downloader)
+            return client
+        
+        first = asyncio.run(analyzer.content_digest(blob_client("a.xlsx", [b"PK\x03\x04", b"rest"]), '"0x1"'))
+        second = asyncio.run(analyzer.content_digest(blob_client("b.xlsx", [b"PK\x03\x04rest"]), '"0x2"'))
+        self.assertEqual(first, hashlib.sha256(b"PK\x03\x04rest").hexdigest())
+        self.assertEqual(first, second)
+        
+        # An unreadable blob runs uncached instead of failing
+        failing = Mock(blob_name="c.xlsx")
+        failing.download_blob = AsyncMock(side_effect=ConnectionError("reset"))
+        self.assertIsNone(asyncio.run(analyzer.content_digest(failing, '"0x3"')))
+        
+        analyzer.cache_enabled = False
+        self.assertIsNone(asyncio.run(analyzer.content_digest(blob_client("a.xlsx", [b"x"]), '"0x1"')))
+
+class TestGetBlobNames(unittest.TestCase):
+    """Unit tests for Event Grid event parsing."""
+    
+    PREFIX = "/blobServices/default/containers/input-files/blobs/"
+    
+    def event(self, body):
+        """Build an Event Hubs message carrying body."""
+        return Mock(get_body=Mock(return_value=body), sequence_number=1)
+    
+    def blob_created(self, subject):
+        """Build a BlobCreated Event Grid event for subject."""
+        return {"eventType": "Microsoft.Storage.BlobCreated", "subject": subject}
+    
+    def test_single_and_list_payloads(self):
+        """Test single-event and list payloads are both read, in order."""
+        from function_app_improved import get_blob_names
+        
+        events = [
+            self.event(json.dumps(self.blob_created(self.PREFIX + "a.xlsx")).encode()),
+            self.event(json.dumps([
+                self.blob_created(self.PREFIX + "b.xlsx"),
+                self.blob_created(self.PREFIX + "reports/c.xlsx")
+            ]).encode())
+        ]
+        
+        self.assertEqual(get_blob_names(events), ["a.xlsx", "b.xlsx", "reports/c.xlsx"])
+    
+    def test_filters_events(self):
+        """Test other containers and event types are ignored."""
+        from function_app_improved import get_blob_names
+        
+        events = [self.event(json.dumps([
+            self.blob_created("/blobServices/default/containers/output-files/blobs/a.xlsx.json"),
+            {"eventType": "Microsoft.Storage.BlobDeleted", "subject": self.PREFIX + "b.xlsx"},
+            self.blob_created(self.PREFIX + "c.xlsx")
+        ]).encode())]
+        
+        self.assertEqual(get_blob_names(events), ["c.xlsx"])
+    
+    def test_skips_malformed_events(self):
+        """Test malformed messages and entries are skipped without losing the batch."""
+        from function_app_improved import get_blob_names
+        
+        events = [
+            self.event(b"not json"),
+            self.event(json.dumps([
+                "not an object",
+                None,
+                {"eventType": "Microsoft.Storage.BlobCreated", "subject": None},
+                {"eventType": "Microsoft.Storage.BlobCreated"},
+                self.blob_created(self.PREFIX + "a.xlsx")
+            ]).encode())
+        ]
+        
+        self.assertEqual(get_blob_names(events), ["a.xlsx"])
+    
+    def test_deduplicates_subjects(self):
+        """Test duplicate deliveries analyze each blob once."""
+        from function_app_improved import get_blob_names
+        
+        body = json.dumps(self.blob_created(self.PREFIX + "a.xlsx")).encode()
+        events = [self.event(body), self.event(body),
+                  self.event(json.dumps(self.blob_created(self.PREFIX + "b.xlsx")).encode())]
+        
+        self.assertEqual(get_blob_names(events), ["a.xlsx", "b.xlsx"])
 
 if __name__ == "__main__":
     unittest.main()
@@ -500,7 +1601,7 @@ This Azure Function automatically processes ESG (Environmental, Social, Governan
 
 ## Features
 
-- **Automatic Processing**: Triggered by Excel file uploads to Azure Blob Storage
+- **Automatic Processing**: Excel uploads to Azure Blob Storage raise Event Grid events that are delivered to the function in batches via Event Hubs
 - **AI-Powered Extraction**: Uses Azure AI Document Intelligence for accurate data extraction
 - **ESG Metric Detection**: Automatically identifies and categorizes ESG metrics
 - **Error Handling**: Comprehensive error handling with retry logic
@@ -511,7 +1612,7 @@ This Azure Function automatically processes ESG (Environmental, Social, Governan
 
 ```
 ┌─────────────────┐     ┌──────────────────┐     ┌────────────────────┐
-│  Excel Upload   │────▶│  Blob Trigger    │────▶│ Document Intelligence│
+│  Excel Upload   │────▶│  Batch Trigger   │────▶│ Document Intelligence│
 │ (input-files)   │     │ Azure Function   │     │    Analysis         │
 └─────────────────┘     └──────────────────┘     └────────────────────┘
                                  │                          │
@@ -528,7 +1629,8 @@ This Azure Function automatically processes ESG (Environmental, Social, Governan
 
 - Python 3.9+
 - Azure Functions Core Tools v4
-- Azurite (Storage Emulator)
+- An Azure Storage account for end-to-end runs (Azurite starts the function, but Document Intelligence reads input files through SAS URLs and cannot reach a local emulator)
+- An Event Hub receiving the storage account's BlobCreated events
 - Visual Studio Code (recommended)
 
 ### Setup
@@ -548,13 +1650,9 @@ This Azure Function automatically processes ESG (Environmental, Social, Governan
 4. Configure local settings:
    - Copy `local.settings.json.example` to `local.settings.json`
    - Add your Document Intelligence endpoint and key
+   - Set `AzureWebJobsStorage` to the storage account's connection string (with `AccountKey`), or `AzureWebJobsStorage__accountName` with `USE_MANAGED_IDENTITY=true`, and `EventHubConnection` to the Event Hubs namespace
 
-5. Start Azurite:
-   ```bash
-   azurite --silent --location c:\azurite --debug c:\azurite\debug.log
-   ```
-
-6. Run the function:
+5. Run the function:
    ```bash
    func start
    ```
@@ -577,13 +1675,35 @@ See the deployment instructions in the main artifact for detailed Azure deployme
 - `DOCUMENTINTELLIGENCE_ENDPOINT`: Document Intelligence service endpoint
 - `DOCUMENTINTELLIGENCE_API_KEY`: API key (for development)
 - `USE_MANAGED_IDENTITY`: Set to "true" for production
-- `AzureWebJobsStorage`: Storage account connection string
+- `AZURE_CLIENT_ID`: Client ID of a user-assigned managed identity (omit for system-assigned)
+- `DI_POLL_INTERVAL`: Seconds between Document Intelligence status polls (default 5)
+- `DI_ANALYSIS_TIMEOUT`: Maximum seconds to wait for one analysis attempt (default 300); retries stop after this plus 120 seconds, and never run past 480 seconds
+- `KEEP_MARKDOWN`: Set to "1" to request markdown content and include it in the output (default "0")
+- `AzureWebJobsStorage`: Storage account connection string (also hosts the `di-cache` container)
+- `AzureWebJobsStorage__accountName`: Storage account name for identity-based access; used instead of `AzureWebJobsStorage` when `USE_MANAGED_IDENTITY` is "true"
+- `EventHubConnection`: Event Hubs connection receiving BlobCreated events for `input-files` on the `esg-blob-events` hub
+- `DI_MAX_CONCURRENCY`: Maximum concurrent Document Intelligence analyses per batch (default 10)
+- `DI_CACHE_ENABLED`: Set to "false" to always re-run Document Intelligence (default "true"). The cache is keyed by a SHA-256 of the file content, so a workbook re-uploaded under any name reuses its extraction. Add a lifecycle management rule to expire old `di-cache` blobs
 
 ### Function Settings
 
 - Maximum file size: 50MB
+- Input files are passed to Document Intelligence as 15-minute read-only SAS URLs, signed with a user delegation key under managed identity (the identity needs Storage Blob Data Contributor) or with the account key otherwise; the storage account must be reachable from the service
 - Timeout: 10 minutes
-- Retry attempts: 3 with exponential backoff
+- Batch size: keep `maxEventBatchSize` at or below `DI_MAX_CONCURRENCY` so every file in a batch starts immediately and finishes within the timeout. Event Hubs does not redeliver a failed batch; failed files get an error document in `output-files` and must be re-uploaded to retry
+
+  ```json
+  {
+    "version": "2.0",
+    "functionTimeout": "00:10:00",
+    "extensions": {
+      "eventHubs": {
+        "maxEventBatchSize": 10
+      }
+    }
+  }
+  ```
+- Retry attempts: 3 with jittered exponential backoff, honoring `Retry-After` on HTTP 429; only timeouts, connection failures and HTTP 408/429/5xx are retried
 
 ## Output Format
 